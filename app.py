@@ -1,24 +1,41 @@
+from __future__ import annotations
+
 import os
 import io
 import time
+import random
 import base64
+import struct
+import tarfile
 import uuid
 import logging
 import datetime
-import PIL.Image
+import threading
+import queue
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from ulid import ULID
 from flask import Flask, render_template, request, jsonify
 from dotenv import load_dotenv
+import google.auth
+import google.auth.credentials
+import requests
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.cloud import storage
+from google.cloud.storage.retry import DEFAULT_RETRY
 from google.api_core import exceptions as google_exceptions
 from google import genai
 from google.genai import types
 from google.cloud import secretmanager
+import google_crc32c
 
 # --- Configuration & Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+# Compile the page template at import so gunicorn --preload shares it with workers via copy-on-write
+app.jinja_env.get_template('index.html')
 
 # Load .env file for local testing
 load_dotenv()
@@ -29,6 +46,35 @@ MODEL_ID_VIDEO = 'veo-3.0-generate-preview'
 PROJECT_ID = os.environ.get("PROJECT_ID")
 GCS_BUCKET_NAME = os.environ.get("GCS_BUCKET_NAME")
 LOCATION = os.environ.get("GOOGLE_CLOUD_REGION", "us-central1")
+MAX_SKETCH_SIZE = (1024, 1024)
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+VIDEO_JOB_TIMEOUT_SECONDS = 300
+SIGNED_URL_TTL = datetime.timedelta(hours=1)
+# A cached signed URL is re-signed once less than this much of its lifetime remains
+SIGNED_URL_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+# Serve the plain public URL when signing fails; only useful for buckets readable by allUsers
+PUBLIC_VIDEO_URL_FALLBACK = os.environ.get("PUBLIC_VIDEO_URL_FALLBACK", "").lower() in ("1", "true", "yes")
+# Finished video jobs stay queryable for one signed-URL lifetime, then are dropped from memory
+VIDEO_JOB_TTL_SECONDS = SIGNED_URL_TTL.total_seconds()
+# Value the tracked .env ships for GOOGLE_API_KEY; it is treated as unset
+API_KEY_PLACEHOLDER = "YOUR_API_KEY"
+# Keep-alive connections per host for GCS; should cover gunicorn threads x concurrent uploads per request
+GCS_HTTP_POOL_SIZE = int(os.environ.get("GCS_HTTP_POOL_SIZE", 64))
+GEMINI_CONCURRENCY_LIMIT = int(os.environ.get("GEMINI_CONCURRENCY_LIMIT", 8))
+VEO_CONCURRENCY_LIMIT = int(os.environ.get("VEO_CONCURRENCY_LIMIT", 4))
+GCS_CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024  # multiple of 256 KiB, as GCS requires for chunk sizes
+
+# Prompts and generation settings, built once rather than per request
+DEFAULT_IMAGE_PROMPT = "Convert this sketch into a photorealistic image as if it were taken from a real DSLR camera. The elements and objects should look real."
+DEFAULT_VIDEO_PROMPT = "Animate this image. Add subtle, cinematic motion."
+IMAGE_GEN_CONFIG = types.GenerateContentConfig(response_modalities=['TEXT', 'IMAGE'])
+VIDEO_GEN_CONFIG_BASE = {
+    "aspect_ratio": "16:9",
+    "duration_seconds": 8,
+    "person_generation": "allow_adult",
+    "enhance_prompt": True,
+    "generate_audio": True,
+}
 
 # Validate environment variables
 REQUIRED_ENV_VARS = ["PROJECT_ID", "GCS_BUCKET_NAME", "GOOGLE_CLOUD_REGION"]
@@ -37,8 +83,15 @@ if missing_vars:
     logger.error(f"Missing environment variables: {', '.join(missing_vars)}")
     raise RuntimeError(f"Missing environment variables: {', '.join(missing_vars)}")
 
+if GEMINI_CONCURRENCY_LIMIT < 1 or VEO_CONCURRENCY_LIMIT < 1:
+    raise RuntimeError("GEMINI_CONCURRENCY_LIMIT and VEO_CONCURRENCY_LIMIT must be at least 1")
+
+# CRC32C upload checksums are only cheap with google-crc32c's C extension
+if google_crc32c.implementation != 'c':
+    logger.warning("google-crc32c is using its pure-Python fallback; GCS upload checksums will be slow")
+
 # --- Securely Fetch API Key from Secret Manager ---
-def get_gemini_api_key():
+def _fetch_from_secret_manager():
     """Fetches the Gemini API key from Google Cloud Secret Manager."""
     try:
         client = secretmanager.SecretManagerServiceClient()
@@ -46,54 +99,122 @@ def get_gemini_api_key():
         response = client.access_secret_version(request={"name": name})
         return response.payload.data.decode("UTF-8")
     except Exception as e:
-        print(f"FATAL: Could not fetch secret 'gemini-api-key' from Secret Manager: {e}")
-        print("Ensure the secret exists and the service account has 'Secret Manager Secret Accessor' role.")
-        return None
-
-logger.info("Fetching Gemini API key...")
-API_KEY = get_gemini_api_key()
-if API_KEY:
-    logger.info(f"API key retrieved: {API_KEY[:5]}...{API_KEY[-5:]}")
-else:
-    logger.error("API key could not be retrieved. The application may not function correctly.")
-
-# Initialize clients
-try:
-    gemini_image_client = genai.Client(api_key=API_KEY)
+        logger.error(f"Could not fetch secret 'gemini-api-key' from Secret Manager: {e}")
+        logger.error("Ensure the secret exists and the service account has 'Secret Manager Secret Accessor' role.")
+        raise RuntimeError("Gemini API key could not be retrieved") from e
+
+def _env_api_key():
+    """Returns GEMINI_API_KEY or GOOGLE_API_KEY, skipping empty values and the .env placeholder."""
+    for var in ("GEMINI_API_KEY", "GOOGLE_API_KEY"):
+        api_key = os.environ.get(var, "").strip()
+        if api_key and api_key != API_KEY_PLACEHOLDER:
+            return api_key
+    return None
+
+@functools.lru_cache(maxsize=1)
+def get_gemini_api_key():
+    """Returns the Gemini API key without a Secret Manager round-trip when one is already available.
+
+    Precedence: GEMINI_API_KEY (e.g. a Cloud Run secret), then GOOGLE_API_KEY (the name used in the
+    local .env, already loaded by load_dotenv; the "YOUR_API_KEY" placeholder counts as unset), then
+    the 'gemini-api-key' secret in Secret Manager.
+    A failed lookup raises, so it is not cached and the next request tries again.
+    """
+    logger.info("Fetching Gemini API key...")
+    api_key = _env_api_key() or _fetch_from_secret_manager()
+    logger.info(f"API key retrieved: {api_key[:5]}...{api_key[-5:]}")
+    return api_key
+
+# --- Lazily Initialized Clients ---
+# Each client is built on first use and then reused for the life of the process, so an instance
+# that never serves traffic never pays for Secret Manager or client setup. Failures raise and are
+# not cached, so the next request retries.
+@functools.lru_cache(maxsize=1)
+def get_gemini_image_client():
+    client = genai.Client(api_key=get_gemini_api_key(), http_options=types.HttpOptions(timeout=120_000))
     logger.info(f"Gemini Image Client initialized for model: {MODEL_ID_IMAGE}")
-except Exception as e:
-    logger.error(f"Failed to initialize Gemini client: {e}")
-    gemini_image_client = None
+    return client
 
-try:
-    veo_video_client = genai.Client(vertexai=True, project=PROJECT_ID, location=LOCATION)
+@functools.lru_cache(maxsize=1)
+def get_veo_video_client():
+    client = genai.Client(vertexai=True, project=PROJECT_ID, location=LOCATION,
+                          http_options=types.HttpOptions(timeout=60_000))
     logger.info(f"Veo Video Client initialized for project: {PROJECT_ID}")
-except Exception as e:
-    logger.error(f"Failed to initialize Veo client: {e}")
-    veo_video_client = None
-
-try:
-    gcs_client = storage.Client(project=PROJECT_ID)
+    return client
+
+@functools.lru_cache(maxsize=1)
+def get_google_credentials():
+    credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+    return credentials
+
+@functools.lru_cache(maxsize=1)
+def get_signing_credentials():
+    # Kept apart from the GCS session's credentials so refreshing them for signBlob never races that session
+    credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+    return credentials
+
+_signing_credentials_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def get_gcs_client():
+    # Shared HTTP session with a connection pool sized for parallel uploads (requests defaults to 10 per host)
+    credentials = get_google_credentials()
+    http_session = AuthorizedSession(credentials)
+    http_session.mount('https://', requests.adapters.HTTPAdapter(
+        pool_connections=32, pool_maxsize=GCS_HTTP_POOL_SIZE, max_retries=3))
+    client = storage.Client(project=PROJECT_ID, credentials=credentials, _http=http_session)
     logger.info("Google Cloud Storage Client initialized")
-except Exception as e:
-    logger.error(f"Failed to initialize GCS client: {e}")
-    gcs_client = None
+    return client
+
+# --- In-Memory Video Job Registry ---
+# Video jobs live in this process only, so the server must run as a single process
+# (use threads for concurrency) for /status to find the job that /generate-video started.
+# Finished and failed jobs are evicted VIDEO_JOB_TTL_SECONDS after they end.
+video_jobs = {}
+video_jobs_lock = threading.Lock()
+# Bookkeeping kept in a job record but never returned by /status
+_INTERNAL_VIDEO_JOB_FIELDS = ("video_blob_name", "finished_at", "signed_url", "signed_url_expires_at")
+# Newly submitted (video_job_id, operation) pairs for the single background poller thread
+_video_job_queue = queue.Queue()
+_video_poller = None
+
+# --- Upstream Concurrency Limits ---
+# Bounded slots for Gemini calls and in-flight Veo operations; requests that cannot get a slot
+# are rejected with 503 + Retry-After rather than queueing into quota errors.
+GEMINI_SEM = threading.BoundedSemaphore(GEMINI_CONCURRENCY_LIMIT)
+VEO_SEM = threading.BoundedSemaphore(VEO_CONCURRENCY_LIMIT)
+
+def try_acquire_slots(semaphore, count: int = 1) -> bool:
+    """Takes `count` slots from `semaphore` without blocking; takes none if they are not all free."""
+    for acquired in range(count):
+        if not semaphore.acquire(blocking=False):
+            release_slots(semaphore, acquired)
+            return False
+    return True
+
+def release_slots(semaphore, count: int = 1):
+    for _ in range(count):
+        semaphore.release()
+
+# Shared pool for GCS uploads that can overlap with other work; the GCS client is thread-safe
+_upload_pool = ThreadPoolExecutor(max_workers=8)
 
 # --- Helper Function to Upload to GCS ---
-def upload_to_gcs(data: bytes or str, bucket_name: str, destination_blob_name: str, content_type: str) -> str:
-    if not gcs_client:
-        logger.error("GCS client is not initialized")
-        raise ConnectionError("GCS client is not initialized")
-    
+def upload_to_gcs(data: bytes | str, bucket_name: str, destination_blob_name: str, content_type: str) -> dict:
     try:
-        bucket = gcs_client.bucket(bucket_name)
+        bucket = get_gcs_client().bucket(bucket_name)
         blob = bucket.blob(destination_blob_name)
-        
-        if isinstance(data, str):
-            blob.upload_from_string(data, content_type=content_type)
-        else:  # bytes
-            blob.upload_from_string(data, content_type=content_type)
-            
+        payload = data.encode('utf-8') if isinstance(data, str) else data
+
+        # The library picks multipart or resumable upload by payload size alone (multipart up to
+        # 8 MiB); chunk_size only sets the resumable chunk size. Sending larger payloads in 8 MiB
+        # chunks means a failure only retries one chunk. Blob names are unique per job, so
+        # retrying the upload is safe.
+        if len(payload) > GCS_CHUNKED_UPLOAD_THRESHOLD:
+            blob.chunk_size = GCS_CHUNKED_UPLOAD_THRESHOLD
+        # CRC32C is what GCS verifies server-side and is hardware-accelerated, unlike MD5
+        blob.upload_from_string(payload, content_type=content_type, retry=DEFAULT_RETRY, checksum='crc32c')
+
         gcs_uri = f"gs://{bucket_name}/{destination_blob_name}"
         public_url = f"https://storage.googleapis.com/{bucket_name}/{destination_blob_name}"
         logger.info(f"Data uploaded to {gcs_uri}, public URL: {public_url}")
@@ -102,6 +223,215 @@ def upload_to_gcs(data: bytes or str, bucket_name: str, destination_blob_name: s
         logger.error(f"GCS upload failed: {e}")
         raise
 
+def build_inputs_archive(image_bytes: bytes, prompt: str) -> bytes:
+    """Packs the original sketch and prompt into an uncompressed tar (user-sketch.png, user-prompt.txt)."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for name, payload in (('user-sketch.png', image_bytes), ('user-prompt.txt', prompt.encode('utf-8'))):
+            info = tarfile.TarInfo(name)
+            info.size = len(payload)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(payload))
+    return buffer.getvalue()
+
+def archive_inputs(image_bytes: bytes, prompt: str, destination_blob_name: str) -> dict:
+    """Builds and uploads the inputs tar; meant to run on _upload_pool, off the request's critical path."""
+    return upload_to_gcs(build_inputs_archive(image_bytes, prompt), GCS_BUCKET_NAME, destination_blob_name, 'application/x-tar')
+
+# --- Background Poller for Veo Operations ---
+def backoff_delay(attempt: int, base_delay: float = 1, max_delay: float = 15) -> float:
+    """Returns an exponential backoff delay for the given attempt, capped and with +/-25% jitter."""
+    delay = min(max_delay, base_delay * 2 ** attempt)
+    return delay * random.uniform(0.75, 1.25)
+
+def _evict_finished_video_jobs():
+    """Drops jobs that ended more than VIDEO_JOB_TTL_SECONDS ago; the caller must hold video_jobs_lock."""
+    cutoff = time.time() - VIDEO_JOB_TTL_SECONDS
+    for video_job_id in [job_id for job_id, job in video_jobs.items() if job.get("finished_at", cutoff) < cutoff]:
+        del video_jobs[video_job_id]
+
+def _set_video_job_error(video_job_id: str, message: str):
+    with video_jobs_lock:
+        video_jobs[video_job_id] = {"state": "error", "done": True, "stage": "failed", "error": message,
+                                    "finished_at": time.time()}
+
+def signed_video_url(video_blob_name: str) -> str:
+    """Returns a 1-hour V4 signed URL for a video in the bucket; raises if it cannot be signed."""
+    credentials = get_signing_credentials()
+    signing_kwargs = {}
+    if not isinstance(credentials, google.auth.credentials.Signing):
+        # Metadata-server credentials have no private key; sign through the IAM signBlob API instead
+        with _signing_credentials_lock:
+            if not credentials.valid:
+                credentials.refresh(Request())
+            signing_kwargs = {"service_account_email": credentials.service_account_email, "access_token": credentials.token}
+    blob = get_gcs_client().bucket(GCS_BUCKET_NAME).blob(video_blob_name)
+    video_url = blob.generate_signed_url(version='v4', expiration=SIGNED_URL_TTL, method='GET',
+                                         credentials=credentials, **signing_kwargs)
+    logger.info(f"Signed video URL generated for: {video_blob_name}")
+    return video_url
+
+def video_job_url(job: dict) -> str:
+    """Returns the finished job's signed URL, signing only when the cached one is missing or about to expire."""
+    now = time.time()
+    with video_jobs_lock:
+        if job.get("signed_url_expires_at", 0) - SIGNED_URL_REFRESH_MARGIN.total_seconds() > now:
+            return job["signed_url"]
+    try:
+        video_url = signed_video_url(job["video_blob_name"])
+    except Exception as e:
+        if not PUBLIC_VIDEO_URL_FALLBACK:
+            raise
+        video_url = f"https://storage.googleapis.com/{GCS_BUCKET_NAME}/{job['video_blob_name']}"
+        logger.warning(f"Could not sign video URL ({e}); falling back to public URL: {video_url}")
+        return video_url
+    with video_jobs_lock:
+        job["signed_url"] = video_url
+        job["signed_url_expires_at"] = now + SIGNED_URL_TTL.total_seconds()
+    return video_url
+
+def _complete_video_job(video_job_id: str, operation):
+    """Records the video blob of a finished Veo operation in video_jobs; /status signs it when asked."""
+    if not operation.response or not operation.result.generated_videos:
+        logger.error("Veo returned no video")
+        raise ValueError("Veo operation completed but returned no video")
+
+    video_gcs_uri = operation.result.generated_videos[0].video.uri
+    logger.info(f"Video saved to GCS at: {video_gcs_uri}")
+
+    bucket_prefix = f"gs://{GCS_BUCKET_NAME}/"
+    video_blob_name = video_gcs_uri[len(bucket_prefix):] if video_gcs_uri.startswith(bucket_prefix) else video_gcs_uri
+
+    with video_jobs_lock:
+        video_jobs[video_job_id] = {"state": "done", "done": True, "stage": "complete",
+                                    "video_blob_name": video_blob_name, "finished_at": time.time()}
+
+def _poll_video_jobs():
+    """Runs forever on one thread, polling every active Veo job with its own jittered backoff."""
+    active_jobs = {}
+    while True:
+        # Sleep until the next job is due, waking early if a new job is submitted
+        timeout = None
+        if active_jobs:
+            timeout = max(0, min(job["next_poll"] for job in active_jobs.values()) - time.time())
+        try:
+            video_job_id, operation = _video_job_queue.get(timeout=timeout)
+            now = time.time()
+            active_jobs[video_job_id] = {
+                "operation": operation,
+                "attempt": 0,
+                "next_poll": now + backoff_delay(0),
+                "deadline": now + VIDEO_JOB_TIMEOUT_SECONDS,
+            }
+            continue
+        except queue.Empty:
+            pass
+
+        now = time.time()
+        for video_job_id, job in list(active_jobs.items()):
+            if job["next_poll"] > now:
+                continue
+            try:
+                operation = job["operation"] = get_veo_video_client().operations.get(job["operation"])
+                # google-genai exposes LRO metadata as a plain dict; Veo does not always report a state
+                stage = str((operation.metadata or {}).get('state') or 'running')
+                logger.info("Video generation status for job %s: %s", video_job_id, stage)
+                with video_jobs_lock:
+                    video_jobs[video_job_id]["stage"] = stage
+                if job["operation"].done:
+                    logger.info(f"Video generation operation complete for job {video_job_id}")
+                    _complete_video_job(video_job_id, job["operation"])
+                elif time.time() > job["deadline"]:
+                    logger.error("Video generation timed out")
+                    raise TimeoutError("Video generation timed out")
+                else:
+                    job["attempt"] += 1
+                    job["next_poll"] = time.time() + backoff_delay(job["attempt"])
+                    continue
+            except google_exceptions.GoogleAPIError as e:
+                logger.error(f"Veo or GCS API error: {e}")
+                _set_video_job_error(video_job_id, f"Failed to generate video: {e}")
+            except (TimeoutError, ValueError) as e:
+                logger.error(f"Video generation failed: {e}")
+                _set_video_job_error(video_job_id, f"Failed to generate video: {e}")
+            except Exception as e:
+                logger.error(f"Unexpected error in video generation: {e}")
+                _set_video_job_error(video_job_id, f"Unexpected error in video generation: {e}")
+            del active_jobs[video_job_id]
+            VEO_SEM.release()
+
+def _ensure_video_poller():
+    """Starts the poller thread on first use, so it runs in the serving process rather than a preloading parent."""
+    global _video_poller
+    with video_jobs_lock:
+        if _video_poller is None or not _video_poller.is_alive():
+            _video_poller = threading.Thread(target=_poll_video_jobs, name="veo-poller", daemon=True)
+            _video_poller.start()
+
+# --- Helper Function to Prepare the Sketch for Gemini ---
+def _png_size(image_bytes: bytes):
+    """Returns (width, height) from a PNG's IHDR chunk, or None if the bytes are not a PNG."""
+    if len(image_bytes) < 24 or image_bytes[:8] != PNG_SIGNATURE or image_bytes[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', image_bytes[16:24])
+
+def prepare_sketch_part(image_bytes: bytes) -> types.Part:
+    """Encodes the sketch once as a Gemini Part so concurrent calls don't each re-serialize a PIL image."""
+    # Browser canvases send PNGs; when one already fits, hand its bytes to Gemini without touching PIL
+    png_size = _png_size(image_bytes)
+    if png_size and png_size[0] <= MAX_SKETCH_SIZE[0] and png_size[1] <= MAX_SKETCH_SIZE[1]:
+        return types.Part.from_bytes(data=image_bytes, mime_type='image/png')
+
+    # Pillow is only needed for non-PNG or oversized sketches, so keep it out of import time
+    import PIL.Image
+
+    # PIL.Image.open is lazy and only parses the header here; image_bytes is uploaded as-is
+    sketch_pil_image = PIL.Image.open(io.BytesIO(image_bytes))
+    original_size = sketch_pil_image.size
+    # Gemini tiles inputs down internally, so large sketches only cost upload bytes.
+    # thumbnail() is a no-op for sketches already within bounds; image_bytes keeps the original for GCS.
+    sketch_pil_image.thumbnail(MAX_SKETCH_SIZE, PIL.Image.LANCZOS)
+
+    if sketch_pil_image.size == original_size:
+        mime_type = PIL.Image.MIME.get(sketch_pil_image.format, 'image/png')
+        return types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
+
+    resized_buffer = io.BytesIO()
+    sketch_pil_image.save(resized_buffer, format='PNG')
+    return types.Part.from_bytes(data=resized_buffer.getvalue(), mime_type='image/png')
+
+# --- Helper Function to Generate and Upload One Image ---
+def _generate_one(i: int, sketch_part: types.Part, prompt: str, job_folder_path: str) -> dict:
+    logger.info(f"Generating image {i+1}")
+    response = get_gemini_image_client().models.generate_content(
+        model=MODEL_ID_IMAGE,
+        contents=[prompt, sketch_part],
+        config=IMAGE_GEN_CONFIG
+    )
+
+    if not response.candidates:
+        logger.error(f"Gemini returned no candidates for image {i+1}")
+        raise ValueError(f"Gemini image generation returned no candidates for image {i+1}")
+
+    generated_image_bytes = None
+    for part in response.candidates[0].content.parts:
+        if part.inline_data and part.inline_data.mime_type.startswith('image/'):
+            generated_image_bytes = part.inline_data.data
+            break
+
+    if not generated_image_bytes:
+        logger.error(f"Gemini response contained no image for image {i+1}")
+        raise ValueError(f"Gemini did not return an image for image {i+1}")
+
+    # Upload generated image to GCS. Gemini already returns encoded PNG bytes, so they go
+    # straight to upload_from_string; do not round-trip them through PIL.
+    image_blob_name = f"{job_folder_path}/images/generated-image-{i+1}.png"
+    upload_result = upload_to_gcs(generated_image_bytes, GCS_BUCKET_NAME, image_blob_name, 'image/png')
+    return {
+        "public_url": upload_result["public_url"],
+        "gcs_uri": upload_result["gcs_uri"]
+    }
+
 # --- Main Routes ---
 @app.route('/')
 def index():
@@ -109,20 +439,46 @@ def index():
 
 @app.route('/generate-images', methods=['POST'])
 def generate_images():
-    if not all([gemini_image_client, gcs_client]):
-        logger.error("One or more clients not initialized")
+    try:
+        get_gemini_image_client()
+        get_gcs_client()
+    except Exception as e:
+        logger.error(f"One or more clients not initialized: {e}")
         return jsonify({"error": "Server-side client initialization failed"}), 500
 
-    if not request.json or 'image_data' not in request.json:
-        logger.error("Missing image_data in request")
-        return jsonify({"error": "Missing image_data in request"}), 400
+    # The sketch arrives either as a raw PNG upload (multipart/form-data, no base64 overhead)
+    # or as a base64 data URL in a JSON body
+    if 'sketch' in request.files:
+        payload = request.form
+        image_bytes = request.files['sketch'].read()
+    else:
+        payload = request.get_json(silent=True)
+        if not payload or 'image_data' not in payload:
+            logger.error("Missing image_data in request")
+            return jsonify({"error": "Missing sketch or image_data in request"}), 400
+
+        # Decode the image data once, slicing off any data URL prefix
+        base64_image_data = payload['image_data']
+        comma = base64_image_data.find(',')
+        base64_data = base64_image_data[comma + 1:] if comma >= 0 else base64_image_data
+        image_bytes = base64.b64decode(base64_data, validate=False)
+
+    if not image_bytes:
+        logger.error("Empty sketch in request")
+        return jsonify({"error": "Empty sketch in request"}), 400
+
+    # PIL raises OSError or SyntaxError for data it cannot decode; that is a bad upload, not a server fault
+    try:
+        sketch_part = prepare_sketch_part(image_bytes)
+    except (OSError, SyntaxError) as e:
+        logger.error(f"Unreadable sketch in request: {e}")
+        return jsonify({"error": "Sketch is not a readable image"}), 400
 
-    base64_image_data = request.json['image_data']
-    user_prompt = request.json.get('prompt', '').strip()
+    user_prompt = payload.get('prompt', '').strip()
     
     # Get and validate the number of images to generate from the request
     try:
-        num_images = int(request.json.get('num_images', 4))
+        num_images = int(payload.get('num_images', 4))
         if not 1 <= num_images <= 4:
             logger.warning(f"Invalid num_images value received: {num_images}. Defaulting to 4.")
             num_images = 4
@@ -130,68 +486,41 @@ def generate_images():
         logger.warning("num_images was not a valid integer. Defaulting to 4.")
         num_images = 4
 
-    # Create a unique folder for this generation job
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    job_id = str(uuid.uuid4())
-    job_folder_path = f"generations/{timestamp}_{job_id[:8]}"
-    logger.info(f"Creating new job folder in GCS: {job_folder_path}")
+    # Shed load instead of stampeding the Gemini quota. A request holds one slot per concurrent call,
+    # capped at the limit so a limit below num_images generates in batches instead of always failing.
+    gemini_slots = min(num_images, GEMINI_CONCURRENCY_LIMIT)
+    if not try_acquire_slots(GEMINI_SEM, gemini_slots):
+        logger.warning(f"Too many concurrent Gemini calls; rejecting request for {num_images} images")
+        return jsonify({"error": "Server is busy generating images, please retry shortly"}), 503, {"Retry-After": "10"}
 
-    # Decode the image data once
-    if ',' in base64_image_data:
-        base64_data = base64_image_data.split(',', 1)[1]
-    else:
-        base64_data = base64_image_data
-    image_bytes = base64.b64decode(base64_data)
+    # Create a unique folder for this generation job; ULIDs sort by creation time
+    job_id = str(ULID())
+    job_folder_path = f"generations/{job_id}"
+    logger.info(f"Creating new job folder in GCS: {job_folder_path}")
 
-    # Store original sketch and prompt in the new job folder
     try:
+        # Store original sketch and prompt in the new job folder while the images are generated.
+        # Both go into one small tar so archiving costs a single GCS request.
         logger.info(f"Uploading original user inputs for job {job_folder_path}")
-        sketch_blob_name = f"{job_folder_path}/sketches/user-sketch.png"
-        prompt_blob_name = f"{job_folder_path}/prompts/user-prompt.txt"
-        
-        upload_to_gcs(image_bytes, GCS_BUCKET_NAME, sketch_blob_name, 'image/png')
-        upload_to_gcs(user_prompt or "No prompt provided.", GCS_BUCKET_NAME, prompt_blob_name, 'text/plain')
-        
-    except Exception as e:
-        logger.error(f"Failed to upload original assets to GCS: {e}")
-        pass
+        inputs_blob_name = f"{job_folder_path}/inputs.tar"
+        archive_upload = _upload_pool.submit(archive_inputs, image_bytes, user_prompt or "No prompt provided.", inputs_blob_name)
 
-    # Generate the requested number of images with Gemini
-    generated_images = []
-    try:
+        # Generate the requested number of images with Gemini
         logger.info(f"Generating {num_images} images from sketch with Gemini")
-        sketch_pil_image = PIL.Image.open(io.BytesIO(image_bytes))
-
-        default_prompt = "Convert this sketch into a photorealistic image as if it were taken from a real DSLR camera. The elements and objects should look real."
-        for i in range(num_images):
-            logger.info(f"Generating image {i+1}")
-            response = gemini_image_client.models.generate_content(
-                model=MODEL_ID_IMAGE,
-                contents=[default_prompt, sketch_pil_image],
-                config=types.GenerateContentConfig(response_modalities=['TEXT', 'IMAGE'])
-            )
-
-            if not response.candidates:
-                logger.error(f"Gemini returned no candidates for image {i+1}")
-                raise ValueError(f"Gemini image generation returned no candidates for image {i+1}")
-
-            generated_image_bytes = None
-            for part in response.candidates[0].content.parts:
-                if part.inline_data and part.inline_data.mime_type.startswith('image/'):
-                    generated_image_bytes = part.inline_data.data
-                    break
-            
-            if not generated_image_bytes:
-                logger.error(f"Gemini response contained no image for image {i+1}")
-                raise ValueError(f"Gemini did not return an image for image {i+1}")
-            
-            # Upload generated image to GCS
-            image_blob_name = f"{job_folder_path}/images/generated-image-{i+1}.png"
-            upload_result = upload_to_gcs(generated_image_bytes, GCS_BUCKET_NAME, image_blob_name, 'image/png')
-            generated_images.append({
-                "public_url": upload_result["public_url"],
-                "gcs_uri": upload_result["gcs_uri"]
-            })
+
+        # Each image is an independent network round-trip, so request them concurrently.
+        # The encoded sketch Part is shared read-only by every call.
+        with ThreadPoolExecutor(max_workers=gemini_slots) as executor:
+            futures = [
+                executor.submit(_generate_one, i, sketch_part, DEFAULT_IMAGE_PROMPT, job_folder_path)
+                for i in range(num_images)
+            ]
+            generated_images = [future.result() for future in futures]
+
+        try:
+            archive_upload.result()
+        except Exception as e:
+            logger.error(f"Failed to upload original assets to GCS: {e}")
         
         logger.info("All images generated and uploaded successfully")
         return jsonify({"job_id": job_id, "images": generated_images})
@@ -205,14 +534,20 @@ def generate_images():
     except Exception as e:
         logger.error(f"Unexpected error in image generation: {e}")
         return jsonify({"error": f"Unexpected error in image generation: {e}"}), 500
+    finally:
+        release_slots(GEMINI_SEM, gemini_slots)
 
 @app.route('/generate-video', methods=['POST'])
 def generate_video():
-    if not all([veo_video_client, gcs_client]):
-        logger.error("One or more clients not initialized")
+    try:
+        veo_video_client = get_veo_video_client()
+        get_gcs_client()
+    except Exception as e:
+        logger.error(f"One or more clients not initialized: {e}")
         return jsonify({"error": "Server-side client initialization failed"}), 500
 
-    if not request.json or 'selected_image_gcs_uri' not in request.json or 'job_id' not in request.json:
+    required_fields = ['selected_image_gcs_uri', 'job_id']
+    if not request.json or not all(field in request.json for field in required_fields):
         logger.error("Missing required fields in request")
         return jsonify({"error": "Missing selected_image_gcs_uri or job_id in request"}), 400
 
@@ -220,69 +555,68 @@ def generate_video():
     user_prompt = request.json.get('prompt', '').strip()
     job_id = request.json['job_id']
 
-    # Reconstruct job folder path
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    job_folder_path = f"generations/{timestamp}_{job_id[:8]}"
+    # Use the job folder created by /generate-images, which is named after the job's ULID
+    try:
+        job_folder_path = f"generations/{ULID.from_str(job_id)}"
+    except (ValueError, TypeError):
+        logger.error(f"Invalid job_id in request: {job_id}")
+        return jsonify({"error": "Invalid job_id in request"}), 400
+
+    # Each in-flight Veo operation holds a slot until the background poller finishes it
+    if not try_acquire_slots(VEO_SEM):
+        logger.warning("Too many concurrent Veo jobs; rejecting video request")
+        return jsonify({"error": "Server is busy generating videos, please retry shortly"}), 503, {"Retry-After": "30"}
 
     try:
         logger.info(f"Generating video from selected image {selected_image_gcs_uri}")
         output_gcs_prefix = f"gs://{GCS_BUCKET_NAME}/{job_folder_path}/videos/"
 
-        default_video_prompt = "Animate this image. Add subtle, cinematic motion."
-        video_prompt = user_prompt if user_prompt else default_video_prompt
+        video_prompt = user_prompt if user_prompt else DEFAULT_VIDEO_PROMPT
 
         operation = veo_video_client.models.generate_videos(
             model=MODEL_ID_VIDEO,
             prompt=video_prompt,
             image=types.Image(gcs_uri=selected_image_gcs_uri, mime_type="image/png"),
-            config=types.GenerateVideosConfig(
-                aspect_ratio="16:9",
-                output_gcs_uri=output_gcs_prefix,
-                duration_seconds=8,
-                person_generation="allow_adult",
-                enhance_prompt=True,
-                generate_audio=True,
-            ),
+            config=types.GenerateVideosConfig(**VIDEO_GEN_CONFIG_BASE, output_gcs_uri=output_gcs_prefix),
         )
-
-        timeout_seconds = 300
-        start_time = time.time()
-        while not operation.done:
-            if time.time() - start_time > timeout_seconds:
-                logger.error("Video generation timed out")
-                raise TimeoutError("Video generation timed out")
-            time.sleep(15)
-            operation = veo_video_client.operations.get(operation)
-            logger.info(f"Video generation status: {operation.metadata.state.name if operation.metadata else 'pending'}")
-
-        logger.info("Video generation operation complete")
-        
-        if not operation.response or not operation.result.generated_videos:
-            logger.error("Veo returned no video")
-            raise ValueError("Veo operation completed but returned no video")
-
-        video_gcs_uri = operation.result.generated_videos[0].video.uri
-        logger.info(f"Video saved to GCS at: {video_gcs_uri}")
-        
-        video_blob_name = video_gcs_uri.replace(f"gs://{GCS_BUCKET_NAME}/", "")
-        public_video_url = f"https://storage.googleapis.com/{GCS_BUCKET_NAME}/{video_blob_name}"
-        logger.info(f"Video public URL: {public_video_url}")
-
-        return jsonify({"generated_video_url": public_video_url})
-
     except google_exceptions.GoogleAPIError as e:
-        logger.error(f"Veo or GCS API error: {e}")
-        return jsonify({"error": f"Failed to generate video: {e}"}), 500
-    except TimeoutError as e:
-        logger.error(f"Video generation timeout: {e}")
-        return jsonify({"error": f"Failed to generate video: {e}"}), 504
-    except ValueError as e:
-        logger.error(f"Video generation failed: {e}")
+        VEO_SEM.release()
+        logger.error(f"Veo API error: {e}")
         return jsonify({"error": f"Failed to generate video: {e}"}), 500
     except Exception as e:
+        VEO_SEM.release()
         logger.error(f"Unexpected error in video generation: {e}")
         return jsonify({"error": f"Unexpected error in video generation: {e}"}), 500
 
+    # Hand the long-running operation to the background poller and return immediately
+    video_job_id = str(uuid.uuid4())
+    with video_jobs_lock:
+        _evict_finished_video_jobs()
+        video_jobs[video_job_id] = {"state": "running", "done": False, "stage": "submitted"}
+    _ensure_video_poller()
+    _video_job_queue.put((video_job_id, operation))
+    logger.info(f"Started video job {video_job_id}")
+
+    return jsonify({"job_id": video_job_id}), 202
+
+@app.route('/status/<job_id>')
+def video_status(job_id):
+    with video_jobs_lock:
+        _evict_finished_video_jobs()
+        job = video_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job_id: {job_id}"}), 404
+
+    status = {key: value for key, value in job.items() if key not in _INTERNAL_VIDEO_JOB_FIELDS}
+    if "video_blob_name" in job:
+        # Never hand out a URL that will 403; report the signing failure instead
+        try:
+            status["url"] = video_job_url(job)
+        except Exception as e:
+            logger.error(f"Could not sign video URL for job {job_id}: {e}")
+            return jsonify({"error": f"Video is ready but its URL could not be signed: {e}"}), 502
+    return jsonify(status)
+
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 8080))
     app.run(debug=True, host='0.0.0.0', port=port)
@@ -0,0 +1,16 @@
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# Video jobs are tracked in memory, so /status only works if every request reaches the same process.
+# Concurrency comes from threads; the Veo wait itself runs on a background poller thread.
+workers = 1
+worker_class = 'gthread'
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+
+# Import the app once in the master before forking
+preload_app = True
+
+# Image generation can take a couple of minutes; keep idle connections open behind a load balancer
+timeout = 360
+keepalive = 75